@@ -7,7 +7,10 @@ Module for predicting with ensembles of pre-trained neural networks
 Created by Maxim Ziatdinov (email: maxim.ziatdinov@ai4microscopy.com)
 """
 
-from typing import Dict, Tuple, Type, Union
+import contextlib
+import copy
+import inspect
+from typing import Callable, Dict, Tuple, Type, Union
 
 import numpy as np
 import torch
@@ -18,6 +21,52 @@ from ..utils import (get_downsample_factor, torch_format_image,
 from .predictor import BasePredictor, Locator
 
 
+def _inference_mode(mode: bool = True):
+    """
+    Returns torch.inference_mode context (PyTorch >= 1.9).
+    Falls back to torch.no_grad on older PyTorch versions
+    """
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode(mode)
+    return torch.no_grad() if mode else contextlib.nullcontext()
+
+
+class EnsembleModule(torch.nn.Module):
+    """
+    Wraps ensemble of models into a single module that returns
+    mean and variance of ensemble prediction
+
+    Args:
+        skeleton: Model skeleton
+        ensemble: Ensemble of trained weights
+        postprocess: Function applied to the output of each model
+        assign:
+            Use the ensemble tensors as model weights instead of copying them
+            (requires PyTorch >= 2.1)
+    """
+    def __init__(self,
+                 skeleton: Type[torch.nn.Module],
+                 ensemble: Dict[int, Dict[str, torch.Tensor]],
+                 postprocess: Callable[[torch.Tensor], torch.Tensor],
+                 assign: bool = False
+                 ) -> None:
+        super(EnsembleModule, self).__init__()
+        self.models = torch.nn.ModuleList()
+        for m in ensemble.values():
+            model = copy.deepcopy(skeleton)
+            if assign:
+                model.load_state_dict(m, assign=True)
+            else:
+                model.load_state_dict(m)
+            self.models.append(model.eval())
+        self.postprocess = postprocess
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
+        eprediction = torch.stack(
+            [self.postprocess(model(x)) for model in self.models])
+        return eprediction.mean(0), eprediction.var(0, unbiased=False)
+
+
 class EnsemblePredictor(BasePredictor):
     """
     Prediction with ensemble of models
@@ -31,6 +80,15 @@ class EnsemblePredictor(BasePredictor):
         in_dim: Input data size (for models with fully-connected layers)
         out_dim: Output data size (for models with fully-connected layers)
         **output_shape: Optionally one may specify the exact output shape
+        **mixed_precision:
+            Run forward passes in float16 with autocast on GPU
+            (Default: False)
+        **cudnn_benchmark:
+            Let cuDNN benchmark convolution algorithms during prediction
+            on GPU. The global setting is restored afterwards (Default: False)
+        **compile:
+            Compile the vectorized ensemble forward pass together with
+            mean/variance reduction using torch.compile (Default: False)
         **verbose: verbosity
     
     Example:
@@ -64,7 +122,21 @@ class EnsemblePredictor(BasePredictor):
                 self.device = "cuda"
             else:
                 self.device = kwargs.get("device")
-        self.model = skeleton
+        self.mixed_precision = (kwargs.get("mixed_precision", False)
+                                and self.device != "cpu")
+        self.cudnn_benchmark = (kwargs.get("cudnn_benchmark", False)
+                                and self.device != "cpu")
+        # Side stream for overlapping host-to-device copies with computation
+        self.copy_stream = None
+        if self.device != "cpu":
+            self.copy_stream = torch.cuda.Stream(self.device)
+        self.model = skeleton.eval()
+        self._model2device()
+        # NHWC layout lets cuDNN use faster (tensor-core) convolution kernels
+        self.channels_last = (
+            self.device != "cpu" and data_type == output_type == "image")
+        if self.channels_last:
+            self.model.to(memory_format=torch.channels_last)
         self.ensemble = ensemble
         self.data_type = data_type
         self.output_type = output_type
@@ -73,33 +145,40 @@ class EnsemblePredictor(BasePredictor):
         self.downsample_factor = None
         self.logits = kwargs.get("logits", True)
         self.output_shape = kwargs.get("output_shape")
+        # Ensemble weights are put on the device only once
+        self.stacked_weights = self._stack_ensemble()
+        # Vectorized (torch.func) ensembling requires PyTorch >= 2.0
+        self.vectorize = hasattr(torch, "func") and hasattr(torch, "vmap")
+        self.vmap_checked = False
+        self.ensemble_step = self._ensemble_step
+        if self.vectorize and kwargs.get("compile", False):
+            # Kernel fusion + CUDA graphs to cut kernel launch overhead
+            self.ensemble_step = torch.compile(
+                self._ensemble_step, mode="reduce-overhead")
+        # Per-model copies and CUDA streams (used when vmap is not available)
+        self.ensemble_module, self.streams = None, None
+        # GPU memory required per sample (keyed by input shape)
+        self.sample_mem = {}
         verbose = kwargs.get("verbose", 1)
-        if verbose:
-            self.everbose = True
-            self.verbose = True if verbose > 1 else False
+        self.everbose = bool(verbose)
+        self.verbose = verbose > 1
 
     def _set_output_shape(self, data: np.ndarray) -> None:
         """
         Sets output shape
         """
-        if self.data_type == self.output_type == "image":
-            if self.nb_classes:  # semantic segmentation
-                out_shape = (len(data), self.nb_classes, *data.shape[2:])
-            else:  # image cleaning
-                out_shape = (len(data), 1, *data.shape[2:])
-        elif self.data_type == "spectra" and self.output_type == "image":
-            if self.nb_classes:
-                out_shape = (len(data), self.nb_classes, *self.out_dim)
-            else:
-                out_shape = (len(data), 1, *self.out_dim)
-        elif self.data_type == "image" and self.output_type == "spectra":
-            out_shape = (len(data), 1, *self.out_dim)
-        elif self.data_type == self.output_type == "spectra":
-            out_shape = (len(data), 1, *data.shape[2:])
-        else:
+        nb_classes = self.nb_classes if self.nb_classes else 1
+        out_shapes = {
+            ("image", "image"): lambda: (nb_classes, *data.shape[2:]),
+            ("spectra", "image"): lambda: (nb_classes, *self.out_dim),
+            ("image", "spectra"): lambda: (1, *self.out_dim),
+            ("spectra", "spectra"): lambda: (1, *data.shape[2:])
+        }
+        out_shape = out_shapes.get((self.data_type, self.output_type))
+        if out_shape is None:
             raise TypeError("Data not understood")
 
-        self.output_shape = out_shape
+        self.output_shape = (len(data), *out_shape())
 
     def preprocess(self,
                    data: np.ndarray,
@@ -116,18 +195,194 @@ class EnsemblePredictor(BasePredictor):
             if data.ndim == 1:
                 data = data[np.newaxis, ...]
             data = torch_format_spectra(data, norm)
+        if self.copy_stream is not None:
+            # Page-locked memory enables asynchronous host-to-device copies
+            data = data.pin_memory()
+        return data
+
+    def _stack_ensemble(self) -> Dict[str, torch.Tensor]:
+        """
+        Stacks weights of all the ensemble models along a new leading
+        dimension and puts them on the selected device
+        """
+        weights = list(self.ensemble.values())
+        stacked_weights = {
+            k: torch.stack([w[k] for w in weights]).to(self.device)
+            for k in weights[0].keys()}
+        if self.channels_last:
+            # Lay out stacked 2D (transposed) convolution weights such that
+            # weights of each model are channels-last
+            stacked_weights = {
+                k: w.permute(0, 1, 3, 4, 2).contiguous().permute(
+                    0, 1, 4, 2, 3) if w.ndim == 5 else w
+                for k, w in stacked_weights.items()}
+        return stacked_weights
+
+    def _data2device(self,
+                     data: torch.Tensor,
+                     device: str = None) -> torch.Tensor:
+        data = super(EnsemblePredictor, self)._data2device(data, device)
+        if self.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
         return data
 
+    def _member_weights(self, i: int) -> Dict[str, torch.Tensor]:
+        """
+        Returns (on-device) weights of the i-th model in the ensemble
+        """
+        return {k: w[i] for k, w in self.stacked_weights.items()}
+
+    def _logits2prob(self, prob: torch.Tensor) -> torch.Tensor:
+        """
+        Converts raw model output to 'probabilities'
+        """
+        nclasses = 0 if not self.nb_classes else self.nb_classes
+        if self.logits:
+            if nclasses > 1:
+                prob = softmax(prob, dim=1)
+            elif self.nb_classes == 1:
+                prob = torch.sigmoid(prob)
+        else:
+            if nclasses > 1:
+                prob = torch.exp(prob)
+        return prob
+
+    def _autocast(self) -> contextlib.AbstractContextManager:
+        """
+        Returns autocast context for (optional) mixed-precision inference
+        """
+        if not self.mixed_precision:  # torch.autocast requires PyTorch >= 1.10
+            return contextlib.nullcontext()
+        return torch.autocast(
+            "cuda", dtype=torch.float16, enabled=self.mixed_precision)
+
+    @contextlib.contextmanager
+    def _cudnn_benchmark(self):
+        """
+        Temporarily enables (optional) cuDNN benchmark mode
+        """
+        benchmark = torch.backends.cudnn.benchmark
+        if self.cudnn_benchmark:
+            torch.backends.cudnn.benchmark = True
+        try:
+            yield
+        finally:
+            torch.backends.cudnn.benchmark = benchmark
+
+    def _member_forward(self,
+                        weights: Dict[str, torch.Tensor],
+                        data: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass through the model skeleton with a given set of weights
+        """
+        prob = torch.func.functional_call(self.model, weights, (data,))
+        return self._logits2prob(prob.float())
+
+    def _ensemble_step(self,
+                       weights: Dict[str, torch.Tensor],
+                       data: torch.Tensor) -> Tuple[torch.Tensor]:
+        """
+        Vectorized forward pass through all the ensemble models
+        followed by mean/variance reduction
+        """
+        eprediction = torch.vmap(self._member_forward, in_dims=(0, None))(
+            weights, data)
+        return eprediction.mean(0), eprediction.var(0, unbiased=False)
+
+    def _check_vmap(self, data: torch.Tensor) -> None:
+        """
+        Checks (once) if the model can be vectorized with vmap by passing
+        a single sample through it. Only errors raised by vmap for
+        unsupported operations disable vectorization; other errors
+        (e.g. out of memory) are propagated
+        """
+        try:
+            with self._autocast():
+                self._ensemble_step(self.stacked_weights, data[:1])
+        except (RuntimeError, NotImplementedError) as e:
+            if type(e) not in (RuntimeError, NotImplementedError):
+                raise
+            self.vectorize = False
+        self.vmap_checked = True
+
+    @_inference_mode()
     def ensemble_forward_(self,
                           data: torch.Tensor,
                           out_shape: Tuple[int]
-                          ) -> Tuple[np.ndarray]:
+                          ) -> Tuple[torch.Tensor]:
+        """
+        Computes mean and variance of prediction with ensemble models.
+        Returns the results on the selected device
+        """
+        if self.vectorize:
+            data_ = self._data2device(data)
+            if not self.vmap_checked:
+                self._check_vmap(data_)
+        if self.vectorize:
+            with self._autocast():
+                return self.ensemble_step(self.stacked_weights, data_)
+        if self.device != "cpu":
+            pred_mean, pred_var = self.concurrent_ensemble_forward(data)
+        else:
+            pred_mean, pred_var = self.running_ensemble_forward(
+                data, out_shape)
+        return pred_mean, pred_var
+
+    def concurrent_ensemble_forward(self,
+                                    data: torch.Tensor
+                                    ) -> Tuple[torch.Tensor]:
         """
         Computes mean and variance of prediction with ensemble models
+        running concurrently, each on its own CUDA stream
         """
-        eprediction = self.ensemble_forward(data, out_shape)
+        if self.ensemble_module is None:
+            # Per-model weights are views into the (on-device) stacked weights
+            with _inference_mode(False):
+                weights = {i: self._member_weights(i)
+                           for i in range(len(self.ensemble))}
+                # Sharing weights requires PyTorch >= 2.1 (copied otherwise)
+                assign = "assign" in inspect.signature(
+                    torch.nn.Module.load_state_dict).parameters
+                self.ensemble_module = EnsembleModule(
+                    self.model, weights, self._logits2prob, assign=assign)
+            self.ensemble_module.requires_grad_(False)
+            self.streams = [torch.cuda.Stream(self.device)
+                            for _ in self.ensemble]
+        data = self._data2device(data)
+        main_stream = torch.cuda.current_stream(self.device)
+        eprediction = []
+        for model, stream in zip(self.ensemble_module.models, self.streams):
+            stream.wait_stream(main_stream)
+            data.record_stream(stream)
+            with torch.cuda.stream(stream), self._autocast():
+                prob = self._logits2prob(model(data).float())
+            prob.record_stream(main_stream)
+            eprediction.append(prob)
+        for stream in self.streams:
+            main_stream.wait_stream(stream)
+        eprediction = torch.stack(eprediction)
+        return eprediction.mean(0), eprediction.var(0, unbiased=False)
 
-        return np.mean(eprediction, axis=0), np.var(eprediction, axis=0)
+    def running_ensemble_forward(self,
+                                 data: torch.Tensor,
+                                 out_shape: Tuple[int]
+                                 ) -> Tuple[torch.Tensor]:
+        """
+        Computes mean and variance of prediction with ensemble models
+        model-by-model, accumulating running statistics (Welford's algorithm)
+        on the selected device
+        """
+        pred_mean = torch.zeros(out_shape, device=self.device)
+        pred_m2 = torch.zeros_like(pred_mean)
+        for i in range(len(self.ensemble)):
+            self.model.load_state_dict(self._member_weights(i))
+            with self._autocast():
+                prob = self.forward_(data)
+            prob = self._logits2prob(prob.float())
+            delta = prob - pred_mean
+            pred_mean += delta / (i + 1)
+            pred_m2 += delta * (prob - pred_mean)
+        return pred_mean, pred_m2 / len(self.ensemble)
 
     def ensemble_forward(self,
                          data: torch.Tensor,
@@ -139,27 +394,18 @@ class EnsemblePredictor(BasePredictor):
         """
         eprediction = np.zeros(
             (len(self.ensemble), *out_shape))
-        for i, m in enumerate(self.ensemble.values()):
-            self.model.load_state_dict(m)
-            self._model2device()
+        for i in range(len(self.ensemble)):
+            self.model.load_state_dict(self._member_weights(i))
             if num_batches > 1:
                 prob = self.batch_predict(
                     data, out_shape, num_batches)
             else:
                 prob = self.forward_(data)
-            nclasses = 0 if not self.nb_classes else self.nb_classes
-            if self.logits:
-                if nclasses > 1:
-                    prob = softmax(prob, dim=1)
-                elif self.nb_classes == 1:
-                    prob = torch.sigmoid(prob)
-            else:
-                if nclasses > 1:
-                    prob = torch.exp(prob)
-            eprediction[i] = prob.cpu().numpy()
+            eprediction[i] = self._logits2prob(prob).cpu().numpy()
 
         return eprediction
 
+    @_inference_mode()
     def ensemble_batch_predict(self,
                                data: np.ndarray,
                                num_batches: int = 10
@@ -167,30 +413,162 @@ class EnsemblePredictor(BasePredictor):
         """
         Batch-by-batch prediction with ensemble models
         """
-        batch_size = len(data) // num_batches
-        if batch_size < 1:
-            num_batches = batch_size = 1
-        prediction_mean = np.zeros(shape=self.output_shape)
-        prediction_var = np.zeros(shape=self.output_shape)
-        for i in range(num_batches):
+        if num_batches is None:
+            batch_size = self._auto_batch_size(data)
+        else:
+            batch_size = max(1, len(data) // num_batches)
+        batches = [slice(i, i + batch_size)
+                   for i in range(0, len(data), batch_size)]
+        out_dims = tuple(self.output_shape[1:])
+        prediction_mean, prediction_var = [], []
+        next_data = self._prefetch(data[batches[0]])
+        for i in range(len(batches)):
             if self.everbose:
-                print("\rBatch {}/{}".format(i+1, num_batches), end="")
-            data_i = data[i*batch_size:(i+1)*batch_size]
-            pred_mean, pred_var = self.ensemble_forward_(
-                data_i, (batch_size, *self.output_shape[1:]))
-            prediction_mean[i*batch_size:(i+1)*batch_size] = pred_mean
-            prediction_var[i*batch_size:(i+1)*batch_size] = pred_var
-        data_i = data[(i+1)*batch_size:]
-        if len(data_i) > 0:
+                print("\rBatch {}/{}".format(i+1, len(batches)), end="")
+            data_i = self._wait_prefetch(next_data)
+            if i + 1 < len(batches):  # copy next batch while computing this one
+                next_data = self._prefetch(data[batches[i+1]])
             pred_mean, pred_var = self.ensemble_forward_(
-                data_i, (len(data_i), *self.output_shape[1:]))
-            prediction_mean[(i+1)*batch_size:] = pred_mean
-            prediction_var[(i+1)*batch_size:] = pred_var
+                data_i, (len(data_i), *out_dims))
+            # Asynchronous device-to-host copies (no sync point per batch)
+            prediction_mean.append(pred_mean.to("cpu", non_blocking=True))
+            prediction_var.append(pred_var.to("cpu", non_blocking=True))
+        if self.copy_stream is not None:
+            torch.cuda.current_stream(self.device).synchronize()
+        prediction_mean = torch.cat(prediction_mean).numpy()
+        prediction_var = torch.cat(prediction_var).numpy()
         return prediction_mean, prediction_var
 
+    def _auto_batch_size(self,
+                         data: torch.Tensor,
+                         mem_fraction: float = 0.6) -> int:
+        """
+        Selects batch size such that each batch fits into a fraction
+        of the available GPU memory. The memory required per sample is
+        estimated once per input shape. On CPU, the data is split
+        into 10 batches
+        """
+        if self.device == "cpu":
+            return max(1, len(data) // 10)
+        if len(data) < 2:
+            return 1
+        sample_shape = tuple(data.shape[1:])
+        if sample_shape not in self.sample_mem:
+            self.sample_mem[sample_shape] = self._probe_sample_mem(data)
+        sample_mem = self.sample_mem[sample_shape]
+        mem_free = torch.cuda.mem_get_info(self.device)[0]
+        # memory held by PyTorch caching allocator is also available to us
+        mem_free += (torch.cuda.memory_reserved(self.device)
+                     - torch.cuda.memory_allocated(self.device))
+        return max(1, int(mem_fraction * mem_free / max(sample_mem, 1)))
+
+    def _probe_sample_mem(self, data: torch.Tensor) -> int:
+        """
+        Estimates GPU memory required per sample as the difference between
+        peak memory of two- and one-sample ensemble predictions, which
+        excludes fixed per-call costs (e.g. reshaped weights in vmap and
+        cuDNN workspace). The device peak memory statistics are restored
+        afterwards
+        """
+        peak_mem = torch.cuda.max_memory_allocated(self.device)
+        probe_mem = []
+        for n in (1, 2):
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            mem_start = torch.cuda.memory_allocated(self.device)
+            self.ensemble_forward_(data[:n], (n, *self.output_shape[1:]))
+            torch.cuda.synchronize(self.device)
+            probe_mem.append(
+                torch.cuda.max_memory_allocated(self.device) - mem_start)
+        # Peak statistics cannot be set directly, so the previous peak
+        # is reached again with a temporary allocation (if possible)
+        extra_mem = peak_mem - torch.cuda.memory_allocated(self.device)
+        if peak_mem > torch.cuda.max_memory_allocated(self.device):
+            try:
+                ptr = torch.cuda.caching_allocator_alloc(
+                    extra_mem, self.device)
+                torch.cuda.caching_allocator_delete(ptr)
+            except RuntimeError:  # out of memory
+                pass
+        return probe_mem[1] - probe_mem[0]
+
+    def _prefetch(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        Starts asynchronous copy of (pinned) data to GPU on a side stream
+        """
+        if self.copy_stream is None or not data.is_pinned():
+            return data
+        with torch.cuda.stream(self.copy_stream):
+            data = data.to(self.device, non_blocking=True)
+        return data
+
+    def _wait_prefetch(self, data: torch.Tensor) -> torch.Tensor:
+        """
+        Makes the compute stream wait for the prefetched data
+        """
+        if self.copy_stream is None or not data.is_cuda:
+            return data
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_stream(self.copy_stream)
+        data.record_stream(compute_stream)
+        return data
+
+    def export_onnx(self,
+                    filepath: str,
+                    dims: Tuple[int] = None,
+                    opset_version: int = None) -> None:
+        """
+        Exports the entire ensemble, including the mean and variance
+        reduction, as a single ONNX graph with a dynamic batch dimension
+        (and dynamic height and width for image-to-image models).
+        The exported file can be used with ONNX Runtime or compiled into
+        a TensorRT engine (e.g. with 'trtexec --onnx=filepath --fp16')
+
+        Args:
+            filepath: Path to the output .onnx file
+            dims:
+                Dimensions of a single input, e.g. (1, 64, 64) for image data.
+                Defaults to (1, *in_dim) or to (1, 64, 64) for images
+            opset_version: ONNX opset version
+        """
+        if dims is None:
+            if self.in_dim is not None:
+                dims = (1, *self.in_dim)
+            elif self.data_type == "image":
+                dims = (1, 64, 64)
+            else:
+                raise ValueError("Specify input dimensions (dims)")
+        # Export a device-independent (CPU, NCHW) graph
+        emodel = EnsembleModule(
+            self.model, self.ensemble, self._logits2prob).eval()
+        emodel.to("cpu", memory_format=torch.contiguous_format)
+        axes = {0: "batch"}
+        if self.data_type == self.output_type == "image":
+            axes.update({2: "height", 3: "width"})
+            # Larger dummy input keeps the (downsampled) spatial dimensions
+            # above 1, so that the tracer does not specialize on their size
+            dims = (dims[0], *(2 * d for d in dims[1:]))
+        dummy = torch.randn(2, *dims)
+        kwargs = {"opset_version": opset_version,
+                  "input_names": ["input"], "output_names": ["mean", "var"]}
+        dynamo = inspect.signature(torch.onnx.export).parameters.get("dynamo")
+        if dynamo is not None and dynamo.default:
+            # torch.export-based exporter (default in PyTorch >= 2.9)
+            torch.onnx.export(
+                emodel, (dummy,), filepath, dynamo=True,
+                dynamic_shapes=({k: torch.export.Dim.DYNAMIC for k in axes},),
+                **kwargs)
+        else:
+            if dynamo is not None:
+                kwargs["dynamo"] = False
+            torch.onnx.export(
+                emodel, (dummy,), filepath,
+                dynamic_axes={k: axes for k in ("input", "mean", "var")},
+                **kwargs)
+
     def predict(self,
                 data: np.ndarray,
-                num_batches: int = 10,
+                num_batches: int = None,
                 format_out: str = "channel_last",
                 norm: bool = True
                 ) -> Tuple[np.ndarray]:
@@ -201,7 +579,9 @@ class EnsemblePredictor(BasePredictor):
         Args:
             data: input data
             num_batches:
-                number of batches for batch-by-batch prediction (Default: 10)
+                number of batches for batch-by-batch prediction.
+                By default, it is selected based on the available
+                GPU memory (or set to 10 when running on CPU)
             format_out:
                 'channel_last' of 'channel_first' dimension order in output
             norm: Normalize input data to (0, 1)
@@ -222,7 +602,8 @@ class EnsemblePredictor(BasePredictor):
            and self.downsample_factor is None):
             self.downsample_factor = get_downsample_factor(self.model)
 
-        prediction = self.ensemble_batch_predict(data, num_batches)
+        with self._cudnn_benchmark():
+            prediction = self.ensemble_batch_predict(data, num_batches)
         prediction_mean, prediction_var = prediction
 
         # channel transpose
@@ -9,6 +9,8 @@ Created by: Maxim Ziatdinov (maxim.ziatdinov@ai4microscopy.com)
 """
 
 import copy
+import functools
+import os
 import subprocess
 from typing import Dict, List, Tuple, Type
 
@@ -17,6 +19,11 @@ import torch
 from torch.nn import (BatchNorm1d, BatchNorm2d, Conv1d, Conv2d,
                       ConvTranspose1d, ConvTranspose2d, Linear)
 
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
 dc = copy.deepcopy
 
 
@@ -70,12 +77,8 @@ def average_weights(ensemble: Dict[int, Dict[str, torch.Tensor]]) -> Dict[str, t
     names = [name for name in ensemble_state_dict.keys() if
              name.split('_')[-1] not in ["mean", "var", "tracked"]]
     for name in names:
-        w_aver = []
-        for model in ensemble.values():
-            for n, p in model.items():
-                if n == name:
-                    w_aver.append(dc(p))
-        ensemble_state_dict[name].copy_(sum(w_aver) / float(len(w_aver)))
+        w_all = torch.stack([model[name] for model in ensemble.values()])
+        ensemble_state_dict[name].copy_(w_all.sum(0) / float(len(ensemble)))
     return ensemble_state_dict
 
 
@@ -100,12 +103,7 @@ def sample_weights(ensemble: Dict[int, Dict[str, torch.Tensor]],
     names = [name for name in ensemble_state_dict.keys() if
              name.split('_')[-1] not in ["mean", "var", "tracked"]]
     for name in names:
-        w_all = []
-        for model in ensemble.values():
-            for n, p in model.items():
-                if n == name:
-                    w_all.append(dc(p)[None, ...])
-        w_all = torch.cat(w_all, dim=0)
+        w_all = torch.stack([model[name] for model in ensemble.values()])
         if w_all.dtype == torch.float32:
             w_all_mu = torch.mean(w_all, axis=0)
             w_all_std = torch.std(w_all, axis=0)
@@ -117,10 +115,16 @@ def sample_weights(ensemble: Dict[int, Dict[str, torch.Tensor]],
 
 def gpu_usage_map(cuda_device: int) -> int:
     """
-    Get the current GPU memory usage
+    Get the current GPU memory usage (in MiB).
+    Queries NVML directly if pynvml (nvidia-ml-py) is installed
+    and falls back to nvidia-smi otherwise.
     Adapted with changes from
     https://discuss.pytorch.org/t/access-gpu-memory-usage-in-pytorch/3192/4
     """
+    if _nvml_available():
+        handle = pynvml.nvmlDeviceGetHandleByIndex(cuda_device)
+        mem = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        return [mem.used // 1024**2, mem.total // 1024**2]
     result = subprocess.check_output(
         [
             'nvidia-smi', '--id=' + str(cuda_device),
@@ -131,6 +135,20 @@ def gpu_usage_map(cuda_device: int) -> int:
     return gpu_usage[0:2]
 
 
+@functools.lru_cache(maxsize=1)
+def _nvml_available() -> bool:
+    """
+    Initializes NVML (once) and checks if it can be used
+    """
+    if pynvml is None:
+        return False
+    try:
+        pynvml.nvmlInit()
+    except pynvml.NVMLError:
+        return False
+    return True
+
+
 def set_train_rng(seed: int = 1):
     """
     For reproducibility
@@ -163,8 +181,18 @@ class Hook():
 
     def hook_fn(self, module: Type[torch.nn.Module],
                 input_: Tuple[torch.Tensor], output_: torch.Tensor) -> None:
-        self.input = input_
-        self.output = output_
+        # Store detached tensors so that the hook does not keep
+        # the autograd graph (and its GPU memory) alive
+        self.input = self._detach(input_)
+        self.output = self._detach(output_)
+
+    @classmethod
+    def _detach(cls, x):
+        if isinstance(x, torch.Tensor):
+            return x.detach()
+        if isinstance(x, (tuple, list)):
+            return tuple(cls._detach(x_) for x_ in x)
+        return x
 
     def close(self) -> None:
         self.hook.remove()
@@ -189,6 +217,8 @@ def get_nb_classes(model: Type[torch.nn.Module]) -> int:
     """
     hookF = [Hook(layer[1]) for layer in list(model._modules.items())]
     mock_forward(model)
+    for hook in hookF:
+        hook.close()
     nb_classes = [hook.output.shape for hook in hookF][-1][1]
     return nb_classes
 
@@ -199,6 +229,8 @@ def get_downsample_factor(model: Type[torch.nn.Module]) -> int:
     """
     hookF = [Hook(layer[1]) for layer in list(model._modules.items())]
     mock_forward(model)
+    for hook in hookF:
+        hook.close()
     imsize = [hook.output.shape[-1] for hook in hookF]
     return max(imsize) / min(imsize)
 
@@ -234,25 +266,41 @@ def nb_filters_classes(weights_path: str) -> Tuple[int]:
             Path to file with saved weights (.pt extension)
 
     """
-    checkpoint = torch.load(weights_path, map_location='cpu')
-    tensor_shapes = [v.shape for v in checkpoint.values() if len(v.shape) > 1]
+    tensor_shapes = _weights_shapes(
+        weights_path, os.path.getmtime(weights_path))
     nb_classes = tensor_shapes[-1][0]
     nb_filters = tensor_shapes[0][0]
     return nb_filters, nb_classes
 
 
+@functools.lru_cache(maxsize=32)
+def _weights_shapes(weights_path: str, mtime: float) -> Tuple[torch.Size]:
+    """
+    Returns shapes of (>1D) tensors in saved weights.
+    Cached by the file path and its modification time
+    """
+    try:  # memory-map storages instead of reading them (PyTorch >= 2.1)
+        checkpoint = torch.load(weights_path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):  # older PyTorch or legacy file format
+        checkpoint = torch.load(weights_path, map_location='cpu')
+    return tuple(v.shape for v in checkpoint.values() if len(v.shape) > 1)
+
+
 def combine_classes(coord_class_dict: Dict[int, np.ndarray],
                     classes_to_combine: List[int],
                     renumerate: bool = True) -> Dict[int, np.ndarray]:
     """
     Combines classes in a dictionary from atomnet.locator or atomnet.predictor outputs
     """
-    coord_class_dict_ = dc(coord_class_dict)
+    coord_class_dict_ = {k: v.copy() for k, v in coord_class_dict.items()}
     for i in range(len(coord_class_dict_)):
-        coord_class_dict_[i][:, -1] = combine_classes_(
-            coord_class_dict_[i][:, -1], classes_to_combine)
-    if renumerate:
-        coord_class_dict_ = renumerate_classes(coord_class_dict_)
+        # Build a lookup table on unique classes and remap in a single pass
+        classes, classes_idx = np.unique(
+            coord_class_dict_[i][:, -1], return_inverse=True)
+        classes = combine_classes_(classes, classes_to_combine)
+        if renumerate:
+            classes = renumerate_classes_(classes)
+        coord_class_dict_[i][:, -1] = classes[classes_idx.ravel()]
     return coord_class_dict_
 
 
@@ -263,9 +311,7 @@ def combine_classes_(classes_all: np.ndarray,
     with a minimum value from the list
     """
     for comb in classes_to_combine:
-        cls_min = min(comb)
-        for c in comb:
-            classes_all[classes_all == c] = cls_min
+        classes_all[np.isin(classes_all, comb)] = min(comb)
     return classes_all
 
 
@@ -275,10 +321,8 @@ def renumerate_classes_(classes: np.ndarray,
     Renumerate classes such that they are ordered starting from 1 or 0
     with an increment of 1
     """
-    diff = np.unique(classes) - np.arange(len(np.unique(classes)))
-    diff_d = {cl: d for d, cl in zip(diff, np.unique(classes))}
-    classes_renum = [cl - diff_d[cl] for cl in classes]
-    classes_renum = np.array(classes_renum, dtype=np.float)
+    _, classes_renum = np.unique(classes, return_inverse=True)
+    classes_renum = classes_renum.reshape(classes.shape).astype(np.float64)
     if start_from_1:
         classes_renum = classes_renum + 1
     return classes_renum
@@ -290,7 +334,7 @@ def renumerate_classes(coord_class_dict: Dict[int, np.ndarray],
     Renumerate classes in a dictionary from atomnet.locator or atomnet.predictor output
     such that they are ordered starting from 1 or 0 with an increment of 1
     """
-    coord_class_dict_ = dc(coord_class_dict)
+    coord_class_dict_ = {k: v.copy() for k, v in coord_class_dict.items()}
     for i in range(len(coord_class_dict)):
         coord_class_dict_[i][:, -1] = renumerate_classes_(
             coord_class_dict_[i][:, -1], start_from_1=True)
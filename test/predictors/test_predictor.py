@@ -0,0 +1,296 @@
+import sys
+import warnings
+
+import numpy as np
+import pytest
+import torch
+from numpy.testing import assert_, assert_allclose
+
+sys.path.append("../../../")
+
+from atomai.nets import Unet
+from atomai.predictors import EnsemblePredictor
+from atomai.predictors.epredictor import EnsembleModule
+
+
+def gen_ensemble(nb_classes, n_models=3):
+    """
+    Dummy ensemble of randomly initialized models
+    """
+    ensemble = {}
+    for i in range(n_models):
+        torch.manual_seed(i)
+        ensemble[i] = Unet(nb_classes=nb_classes).state_dict()
+    return ensemble
+
+
+def serial_ensemble_forward(nb_classes, ensemble, data):
+    """
+    Reference ensemble prediction (model-by-model)
+    """
+    eprediction = []
+    for weights in ensemble.values():
+        model = Unet(nb_classes=nb_classes)
+        model.load_state_dict(weights)
+        with torch.no_grad():
+            prob = model.eval()(data.cpu())
+        if nb_classes > 1:
+            prob = torch.softmax(prob, dim=1)
+        else:
+            prob = torch.sigmoid(prob)
+        eprediction.append(prob.numpy())
+    eprediction = np.stack(eprediction)
+    return eprediction.mean(0), eprediction.var(0)
+
+
+@pytest.mark.parametrize("nb_classes", [1, 3])
+def test_vectorized_forward(nb_classes):
+    ensemble = gen_ensemble(nb_classes)
+    data = torch.rand(4, 1, 8, 8)
+    p = EnsemblePredictor(
+        Unet(nb_classes=nb_classes), ensemble, nb_classes=nb_classes)
+    pred_mean, pred_var = p.ensemble_forward_(data, (4, nb_classes, 8, 8))
+    assert_(p.vectorize)
+    ref_mean, ref_var = serial_ensemble_forward(nb_classes, ensemble, data)
+    assert_allclose(pred_mean.numpy(), ref_mean, atol=1e-5)
+    assert_allclose(pred_var.numpy(), ref_var, atol=1e-5)
+
+
+@pytest.mark.parametrize("num_batches", [1, 3, 10])
+@pytest.mark.parametrize("nb_classes", [1, 3])
+def test_ensemble_predict(nb_classes, num_batches):
+    ensemble = gen_ensemble(nb_classes)
+    X = np.random.random(size=(5, 8, 8))
+    p = EnsemblePredictor(
+        Unet(nb_classes=nb_classes), ensemble, nb_classes=nb_classes)
+    pred_mean, pred_var = p.predict(X, num_batches)
+    assert_(pred_mean.shape == pred_var.shape == (5, 8, 8, nb_classes))
+    data = p.preprocess(X)
+    ref_mean, ref_var = serial_ensemble_forward(nb_classes, ensemble, data)
+    assert_allclose(pred_mean, ref_mean.transpose(0, 2, 3, 1), atol=1e-5)
+    assert_allclose(pred_var, ref_var.transpose(0, 2, 3, 1), atol=1e-5)
+
+
+@pytest.mark.parametrize("nb_classes", [1, 3])
+def test_running_ensemble_forward(nb_classes):
+    ensemble = gen_ensemble(nb_classes)
+    data = torch.rand(4, 1, 8, 8)
+    p = EnsemblePredictor(
+        Unet(nb_classes=nb_classes), ensemble, nb_classes=nb_classes)
+    p.vectorize = False
+    pred_mean, pred_var = p.ensemble_forward_(data, (4, nb_classes, 8, 8))
+    ref_mean, ref_var = serial_ensemble_forward(nb_classes, ensemble, data)
+    assert_allclose(pred_mean.numpy(), ref_mean, atol=1e-5)
+    assert_allclose(pred_var.numpy(), ref_var, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "use_gpu, channels_last",
+    [(False, False), (False, True),
+     pytest.param(True, False, marks=pytest.mark.skipif(
+         not torch.cuda.is_available(), reason="requires GPU"))])
+def test_export_onnx(tmp_path, use_gpu, channels_last):
+    ort = pytest.importorskip("onnxruntime")
+    ensemble = gen_ensemble(3)
+    p = EnsemblePredictor(
+        Unet(nb_classes=3), ensemble, nb_classes=3, use_gpu=use_gpu)
+    if channels_last:
+        p.model.to(memory_format=torch.channels_last)
+    filepath = str(tmp_path / "ensemble.onnx")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        p.export_onnx(filepath, dims=(1, 8, 8))
+    session = ort.InferenceSession(filepath)
+    for data in (torch.rand(4, 1, 8, 8), torch.rand(1, 1, 16, 24)):
+        pred_mean, pred_var = session.run(None, {"input": data.numpy()})
+        ref_mean, ref_var = serial_ensemble_forward(3, ensemble, data)
+        assert_allclose(pred_mean, ref_mean, atol=1e-5)
+        assert_allclose(pred_var, ref_var, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "data_type, output_type, nb_classes, out_shape",
+    [("image", "image", 3, (5, 3, 8, 8)),
+     ("image", "image", None, (5, 1, 8, 8)),
+     ("spectra", "image", 2, (5, 2, 4, 4)),
+     ("image", "spectra", None, (5, 1, 16)),
+     ("spectra", "spectra", None, (5, 1, 16))])
+def test_set_output_shape(data_type, output_type, nb_classes, out_shape):
+    in_dim = (8, 8) if data_type == "image" else (16,)
+    out_dim = (4, 4) if output_type == "image" else (16,)
+    data = torch.rand(5, 1, *in_dim)
+    p = EnsemblePredictor(
+        Unet(), gen_ensemble(1, 1), data_type, output_type,
+        nb_classes, in_dim, out_dim)
+    p._set_output_shape(data)
+    assert_(p.output_shape == out_shape)
+
+
+def test_ensemble_predict_silent():
+    ensemble = gen_ensemble(1)
+    X = np.random.random(size=(5, 8, 8))
+    p = EnsemblePredictor(Unet(), ensemble, nb_classes=1, verbose=0)
+    pred_mean, pred_var = p.predict(X)
+    assert_(pred_mean.shape == pred_var.shape == (5, 8, 8, 1))
+
+
+def test_ensemble_predict_no_hooks():
+    ensemble = gen_ensemble(3)
+    p = EnsemblePredictor(Unet(nb_classes=3), ensemble, nb_classes=3)
+    p.predict(np.random.random(size=(5, 8, 8)))
+    assert_(all(not m._forward_hooks for m in p.model.modules()))
+
+
+def test_ensemble_predict_compile():
+    ensemble = gen_ensemble(3)
+    X = np.random.random(size=(5, 8, 8))
+    p = EnsemblePredictor(
+        Unet(nb_classes=3), ensemble, nb_classes=3, compile=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        pred_mean, pred_var = p.predict(X, 1)
+    assert_(p.vectorize)
+    assert_(p.ensemble_step != p._ensemble_step)
+    assert_(hasattr(p.ensemble_step, "_torchdynamo_orig_callable"))
+    p_eager = EnsemblePredictor(Unet(nb_classes=3), ensemble, nb_classes=3)
+    ref_mean, ref_var = p_eager.predict(X, 1)
+    assert_allclose(pred_mean, ref_mean, atol=1e-5)
+    assert_allclose(pred_var, ref_var, atol=1e-5)
+
+
+class ItemUnet(Unet):
+    """
+    Unet with an operation that is not supported by vmap
+    """
+    def forward(self, x):
+        out = super(ItemUnet, self).forward(x)
+        return out * float(out.std().item() > 0)
+
+
+def test_vmap_fallback():
+    ensemble = gen_ensemble(3)
+    data = torch.rand(4, 1, 8, 8)
+    p = EnsemblePredictor(ItemUnet(nb_classes=3), ensemble, nb_classes=3)
+    pred_mean, pred_var = p.ensemble_forward_(data, (4, 3, 8, 8))
+    assert_(p.vmap_checked and not p.vectorize)
+    ref_mean, ref_var = serial_ensemble_forward(3, ensemble, data)
+    assert_allclose(pred_mean.numpy(), ref_mean, atol=1e-5)
+    assert_allclose(pred_var.numpy(), ref_var, atol=1e-5)
+
+
+def test_vmap_error_propagates():
+    ensemble = gen_ensemble(3)
+    p = EnsemblePredictor(Unet(nb_classes=3), ensemble, nb_classes=3)
+
+    def ensemble_step(weights, data):
+        raise torch.OutOfMemoryError("out of memory")
+
+    p._ensemble_step = p.ensemble_step = ensemble_step
+    with pytest.raises(torch.OutOfMemoryError):
+        p.ensemble_forward_(torch.rand(4, 1, 8, 8), (4, 3, 8, 8))
+    assert_(p.vectorize)
+
+
+def test_cudnn_benchmark_restored():
+    ensemble = gen_ensemble(1)
+    p = EnsemblePredictor(Unet(), ensemble, nb_classes=1,
+                          cudnn_benchmark=True)
+    p.cudnn_benchmark = True  # emulate GPU setting
+    torch.backends.cudnn.benchmark = False
+    with p._cudnn_benchmark():
+        assert_(torch.backends.cudnn.benchmark)
+    assert_(not torch.backends.cudnn.benchmark)
+    p.predict(np.random.random(size=(5, 8, 8)))
+    assert_(not torch.backends.cudnn.benchmark)
+
+
+@pytest.mark.parametrize("assign", [True, False])
+def test_ensemble_module_weights(assign):
+    ensemble = gen_ensemble(3)
+    p = EnsemblePredictor(Unet(nb_classes=3), ensemble, nb_classes=3)
+    weights = {i: p._member_weights(i) for i in range(len(ensemble))}
+    emodel = EnsembleModule(p.model, weights, p._logits2prob, assign=assign)
+    for i, model in enumerate(emodel.models):
+        for k, w in model.state_dict().items():
+            assert_((w.data_ptr() == weights[i][k].data_ptr()) == assign)
+    data = torch.rand(4, 1, 8, 8)
+    with torch.no_grad():
+        pred_mean, pred_var = emodel(data)
+    ref_mean, ref_var = serial_ensemble_forward(3, ensemble, data)
+    assert_allclose(pred_mean.numpy(), ref_mean, atol=1e-5)
+    assert_allclose(pred_var.numpy(), ref_var, atol=1e-5)
+
+
+def test_channels_last():
+    ensemble = gen_ensemble(3)
+    data = torch.rand(4, 1, 8, 8)
+    p = EnsemblePredictor(Unet(nb_classes=3), ensemble, nb_classes=3)
+    p.channels_last = True  # emulate GPU setting
+    p.stacked_weights = p._stack_ensemble()
+    for k, w in p._member_weights(1).items():
+        if w.ndim == 4:
+            assert_(w.is_contiguous(memory_format=torch.channels_last))
+    assert_(p._data2device(data).is_contiguous(
+        memory_format=torch.channels_last))
+    pred_mean, pred_var = p.ensemble_forward_(data, (4, 3, 8, 8))
+    ref_mean, ref_var = serial_ensemble_forward(3, ensemble, data)
+    assert_allclose(pred_mean.numpy(), ref_mean, atol=1e-5)
+    assert_allclose(pred_var.numpy(), ref_var, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires GPU")
+@pytest.mark.parametrize("nb_classes", [1, 3])
+def test_concurrent_ensemble_forward(nb_classes):
+    ensemble = gen_ensemble(nb_classes)
+    data = torch.rand(4, 1, 8, 8)
+    p = EnsemblePredictor(
+        Unet(nb_classes=nb_classes), ensemble, nb_classes=nb_classes)
+    p.vectorize = False
+    pred_mean, pred_var = p.ensemble_forward_(data, (4, nb_classes, 8, 8))
+    eprediction = p.ensemble_forward(data, (4, nb_classes, 8, 8))
+    assert_allclose(pred_mean.cpu().numpy(), eprediction.mean(0), atol=1e-5)
+    assert_allclose(pred_var.cpu().numpy(), eprediction.var(0), atol=1e-5)
+    ref_mean, ref_var = serial_ensemble_forward(nb_classes, ensemble, data)
+    assert_allclose(pred_mean.cpu().numpy(), ref_mean, atol=1e-5)
+    assert_allclose(pred_var.cpu().numpy(), ref_var, atol=1e-5)
+
+
+def test_auto_batch_size(monkeypatch):
+    ensemble = gen_ensemble(1)
+    X = np.random.random(size=(10, 8, 8))
+    p = EnsemblePredictor(Unet(), ensemble, nb_classes=1)
+    batch_sizes = []
+    ensemble_forward_ = p.ensemble_forward_
+    # emulate GPU with a fixed cost of 100 and a per-sample cost of 10
+    # (memory for 3 samples per batch), and a previous peak of 500
+    mem = {"peak": 500}
+
+    def forward_(data, out_shape):
+        batch_sizes.append(len(data))
+        mem["peak"] = max(mem["peak"], 100 + 10 * len(data))
+        return ensemble_forward_(data, out_shape)
+
+    def alloc(size, device):
+        mem["peak"] = max(mem["peak"], size)
+
+    p.ensemble_forward_ = forward_
+    p.device = "cuda:fake"
+    p._data2device = lambda data, device=None: data
+    monkeypatch.setattr(torch.cuda, "synchronize", lambda device: None)
+    monkeypatch.setattr(torch.cuda, "reset_peak_memory_stats",
+                        lambda device: mem.update(peak=0))
+    monkeypatch.setattr(torch.cuda, "memory_allocated", lambda device: 0)
+    monkeypatch.setattr(torch.cuda, "memory_reserved", lambda device: 0)
+    monkeypatch.setattr(torch.cuda, "max_memory_allocated",
+                        lambda device: mem["peak"])
+    monkeypatch.setattr(torch.cuda, "mem_get_info", lambda device: (50, 100))
+    monkeypatch.setattr(torch.cuda, "caching_allocator_alloc", alloc)
+    monkeypatch.setattr(torch.cuda, "caching_allocator_delete", lambda p: None)
+    pred_mean, _ = p.predict(X)
+    assert_(pred_mean.shape == (10, 8, 8, 1))
+    assert_(batch_sizes == [1, 2, 3, 3, 3, 1])  # probes + batches
+    assert_(p.sample_mem == {(1, 8, 8): 10})
+    assert_(mem["peak"] == 500)  # previous peak is restored
+    batch_sizes.clear()
+    p.predict(X)  # cached estimate, no probe
+    assert_(batch_sizes == [3, 3, 3, 1])
@@ -0,0 +1,128 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+import torch
+from numpy.testing import assert_, assert_equal
+
+sys.path.append("../../../")
+
+from atomai.nets import Unet
+from atomai.utils import nn
+from atomai.utils.nn import (Hook, average_weights, combine_classes,
+                             combine_classes_, get_downsample_factor,
+                             get_nb_classes, gpu_usage_map,
+                             nb_filters_classes, renumerate_classes,
+                             renumerate_classes_)
+
+
+@pytest.mark.parametrize(
+    "start_from_1, expected",
+    [(True, [1, 3, 2, 3, 1]), (False, [0, 2, 1, 2, 0])])
+def test_renumerate_classes_(start_from_1, expected):
+    classes = np.array([2., 7., 5., 7., 2.])
+    classes_renum = renumerate_classes_(classes, start_from_1)
+    assert_equal(classes_renum, np.array(expected, dtype=np.float64))
+
+
+def test_renumerate_classes():
+    coord_class_dict = {
+        0: np.array([[1., 1., 3.], [2., 2., 5.], [3., 3., 3.]]),
+        1: np.array([[1., 1., 0.], [2., 2., 4.]])}
+    coord_class_dict_ = renumerate_classes(coord_class_dict)
+    assert_equal(coord_class_dict_[0][:, -1], [1, 2, 1])
+    assert_equal(coord_class_dict_[1][:, -1], [1, 2])
+    assert_equal(coord_class_dict[0][:, -1], [3, 5, 3])
+
+
+def test_combine_classes_():
+    classes = np.array([1., 2., 3., 4., 5., 6., 2.])
+    classes_comb = combine_classes_(classes, [[2, 4], [3, 5, 6]])
+    assert_equal(classes_comb, [1, 2, 3, 2, 3, 3, 2])
+
+
+def test_combine_classes():
+    coord_class_dict = {
+        0: np.array([[1., 1., 1.], [2., 2., 4.], [3., 3., 6.]]),
+        1: np.array([[1., 1., 6.], [2., 2., 1.]])}
+    coord_class_dict_ = combine_classes(coord_class_dict, [[4, 6]])
+    assert_equal(coord_class_dict_[0][:, -1], [1, 2, 2])
+    assert_equal(coord_class_dict_[1][:, -1], [2, 1])
+    assert_equal(coord_class_dict[0][:, -1], [1, 4, 6])
+    coord_class_dict_ = combine_classes(
+        coord_class_dict, [[4, 6]], renumerate=False)
+    assert_equal(coord_class_dict_[0][:, -1], [1, 4, 4])
+    assert_equal(coord_class_dict_[1][:, -1], [4, 1])
+
+
+def test_nb_filters_classes(tmp_path):
+    weights_path = str(tmp_path / "weights.pt")
+    torch.save(Unet(nb_classes=3, nb_filters=8).state_dict(), weights_path)
+    assert_equal(nb_filters_classes(weights_path), (8, 3))
+    torch.save(Unet(nb_classes=2, nb_filters=16).state_dict(), weights_path)
+    os.utime(weights_path, (0, 1))  # make sure modification time changes
+    assert_equal(nb_filters_classes(weights_path), (16, 2))
+
+
+def test_hook_detached():
+    model = Unet(nb_classes=3)
+    hook = Hook(model.c1)
+    model(torch.randn(2, 1, 16, 16))
+    assert_(not hook.output.requires_grad)
+    assert_(all(not x.requires_grad for x in hook.input))
+    hook.close()
+
+
+def test_average_weights():
+    ensemble = {i: {"w": torch.full((2, 2), float(i)),
+                    "steps": torch.tensor(2 * i)} for i in range(3)}
+    ensemble_state_dict = average_weights(ensemble)
+    assert_equal(ensemble_state_dict["w"].numpy(), np.ones((2, 2)))
+    assert_(ensemble_state_dict["steps"].item() == 2)
+    assert_(ensemble_state_dict["steps"].dtype == torch.int64)
+
+
+def test_mock_forward_hooks_removed():
+    model = Unet(nb_classes=3)
+    assert_equal(get_downsample_factor(model), 8)
+    assert_equal(get_nb_classes(model), 3)
+    assert_(all(not m._forward_hooks for m in model.modules()))
+
+
+def fake_pynvml(init_error=False):
+    """
+    Minimal stand-in for pynvml with 1 GiB used out of 8 GiB
+    """
+    class NVMLError(Exception):
+        pass
+
+    def nvmlInit():
+        if init_error:
+            raise NVMLError("NVML Shared Library Not Found")
+
+    def nvmlDeviceGetMemoryInfo(handle):
+        assert_(handle == "handle-1")
+        return types.SimpleNamespace(used=1024**3, total=8 * 1024**3)
+
+    return types.SimpleNamespace(
+        NVMLError=NVMLError, nvmlInit=nvmlInit,
+        nvmlDeviceGetHandleByIndex=lambda i: "handle-{}".format(i),
+        nvmlDeviceGetMemoryInfo=nvmlDeviceGetMemoryInfo)
+
+
+@pytest.mark.parametrize(
+    "pynvml, expected",
+    [(fake_pynvml(), [1024, 8192]),
+     (fake_pynvml(init_error=True), [100, 200]),
+     (None, [100, 200])])
+def test_gpu_usage_map(monkeypatch, pynvml, expected):
+    monkeypatch.setattr(nn, "pynvml", pynvml)
+    monkeypatch.setattr(
+        nn.subprocess, "check_output", lambda *args, **kwargs: "100, 200, 5\n")
+    nn._nvml_available.cache_clear()
+    try:
+        assert_equal(gpu_usage_map(1), expected)
+    finally:
+        nn._nvml_available.cache_clear()